@@ -1,7 +1,34 @@
 import asyncio
-from typing import Optional, List, Dict, Any, Callable
+import copy
+import logging
+import time
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Callable, Iterator, Tuple
 from pathlib import Path
 
+from utils.log import DIAGNOSTICS_LOGGER, diagnostics_sampled
+
+logger = logging.getLogger(__name__)
+diagnostics = logging.getLogger(DIAGNOSTICS_LOGGER)
+
+
+@contextmanager
+def _stage(timings: Dict[str, float], name: str) -> Iterator[None]:
+    # Duración de cada etapa del pipeline en milisegundos
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def _cache_state(hits: List[bool]) -> Optional[str]:
+    if not hits:
+        return None
+    if all(hits):
+        return "hit"
+    return "miss" if not any(hits) else "mixed"
+
 
 class SimpleAgent:
 
@@ -13,7 +40,8 @@ class SimpleAgent:
         tool1: Optional[Callable] = None,
         tool2: Optional[Callable] = None,
         tool1_desc: str = "",
-        tool2_desc: str = ""
+        tool2_desc: str = "",
+        recorder=None
     ):
 
         self.llm = llm
@@ -22,14 +50,23 @@ class SimpleAgent:
         self.tool2 = tool2
         self.tool1_desc = tool1_desc
         self.tool2_desc = tool2_desc
+        self.recorder = recorder
 
         prompt_path = Path(__file__).parent.parent / "prompts" / "system_prompt.txt"
         
         if prompt_path.exists():
             self.system_prompt_template = prompt_path.read_text(encoding="utf-8")
-            print(f"[AGENT] Prompt cargado desde {prompt_path}")
+            logger.info("Prompt cargado desde %s", prompt_path)
         else:
-            print(f"[AGENT] Archivo de prompt no encontrado: {prompt_path}")
+            logger.warning("Archivo de prompt no encontrado: %s", prompt_path)
+
+    def with_tools(self, tool1: Optional[Callable], tool2: Optional[Callable]) -> "SimpleAgent":
+        # Copia ligera que comparte llm, memoria y prompt pero usa otras
+        # herramientas (p. ej. las versiones agrupadas de /chat/batch)
+        agent = copy.copy(self)
+        agent.tool1 = tool1
+        agent.tool2 = tool2
+        return agent
                 
     async def expand_query(self, query: str) -> List[str]:
 
@@ -105,37 +142,96 @@ class SimpleAgent:
             if match_diff >= 3:  
                 result['threshold_kb1'] = 0.50
                 result['threshold_kb2'] = 0.70
-                print(f"[CLASIFICACIÓN] POLÍTICAS/LEGAL (Alta confianza: {kb1_matches} vs {kb2_matches}) - Thresholds: KB1=0.50, KB2=0.70")
             else:  # Confianza moderada
                 result['threshold_kb1'] = 0.55
                 result['threshold_kb2'] = 0.65
-                print(f"[CLASIFICACIÓN] POLÍTICAS/LEGAL (Confianza moderada: {kb1_matches} vs {kb2_matches}) - Thresholds: KB1=0.55, KB2=0.65")
         elif kb2_matches > kb1_matches:
             result['prioritize'] = 'kb2'
             # KB2 prioritaria: threshold más permisivo en KB2, más estricto en KB1
             if match_diff >= 3:  # Alta confianza
                 result['threshold_kb1'] = 0.70
                 result['threshold_kb2'] = 0.50
-                print(f"[CLASIFICACIÓN] TARIFAS/OPERACIONES (Alta confianza: {kb2_matches} vs {kb1_matches}) - Thresholds: KB1=0.70, KB2=0.50")
             else:  # Confianza moderada
                 result['threshold_kb1'] = 0.65
                 result['threshold_kb2'] = 0.55
-                print(f"[CLASIFICACIÓN] TARIFAS/OPERACIONES (Confianza moderada: {kb2_matches} vs {kb1_matches}) - Thresholds: KB1=0.65, KB2=0.55")
         else:
             # Sin clasificación clara: thresholds moderados y balanceados
             result['threshold_kb1'] = 0.55
             result['threshold_kb2'] = 0.55
-            print(f"[CLASIFICACIÓN] GENERAL (sin preferencia clara: {kb1_matches} vs {kb2_matches}) - Thresholds: KB1=0.55, KB2=0.55")
+        
+        logger.info(
+            "Clasificación de la consulta",
+            extra={
+                'prioritize': result['prioritize'] or 'general',
+                'high_confidence': match_diff >= 3 and result['prioritize'] is not None,
+                'kb1_matches': kb1_matches,
+                'kb2_matches': kb2_matches,
+                'threshold_kb1': result['threshold_kb1'],
+                'threshold_kb2': result['threshold_kb2'],
+            }
+        )
         
         return result
 
     async def run(self, chat_id: str, user_message: str) -> str:
 
-        await self.memory.add_message(chat_id, "user", user_message)
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
 
-        recent = await self.memory.get_recent(chat_id, limit=8)
+        with _stage(timings, 'memory_add'):
+            await self.memory.add_message(chat_id, "user", user_message)
 
-        classification = await self.classify_question(user_message)
+        with _stage(timings, 'history'):
+            recent = await self.memory.get_recent(chat_id, limit=8)
+
+        cache: Dict[str, Optional[str]] = {}
+        classification, docs1, docs2 = await self.retrieve(user_message, timings, cache)
+
+        with _stage(timings, 'prompt'):
+            kb1_context = self._format_docs(docs1)
+            kb2_context = self._format_docs(docs2)
+            history = self._format_history(recent)
+            
+            prompt = self.system_prompt_template.format(
+                kb1_desc=self.tool1_desc,
+                kb1_context=kb1_context,
+                kb2_desc=self.tool2_desc,
+                kb2_context=kb2_context,
+                history=history,
+                query=user_message
+            )
+
+        with _stage(timings, 'llm'):
+            reply = await self.llm.generate(prompt)
+
+        with _stage(timings, 'memory_save'):
+            await self.memory.add_message(chat_id, "agent", reply)
+
+        timings['total'] = round((time.perf_counter() - started) * 1000, 2)
+        if self.recorder is not None:
+            self.recorder.record_request(user_message, classification, docs1, docs2, len(prompt), timings, cache)
+
+        return reply
+
+    async def retrieve(
+        self, 
+        user_message: str, 
+        timings: Optional[Dict[str, float]] = None,
+        cache: Optional[Dict[str, Optional[str]]] = None
+    ) -> Tuple[Dict[str, Any], List[Any], List[Any]]:
+        # `cache` recibe, por KB, si la recuperación se sirvió de la cache de
+        # resultados ("hit", "miss" o "mixed"); sin ello las latencias grabadas
+        # y las de replay no son comparables.
+
+        if timings is None:
+            timings = {}
+        if cache is None:
+            cache = {}
+        kb1_hits: List[bool] = []
+        kb2_hits: List[bool] = []
+
+        with _stage(timings, 'classify'):
+            classification = await self.classify_question(user_message)
 
         docs1 = []
         docs2 = []
@@ -153,14 +249,15 @@ class SimpleAgent:
         
         async def search_kb1():
             if not self.tool1:
-                print(f"[QDRANT]  KB-1: Herramienta no disponible")
+                logger.warning("KB-1: herramienta no disponible")
                 return []
             try:
                 results = await self.tool1(
                     main_query, 
                     k=k1, 
                     metadata_filter=classification['kb1_filter'], 
-                    score_threshold=score_threshold_kb1
+                    score_threshold=score_threshold_kb1,
+                    cache_hits=kb1_hits
                 )
                 
                 if len(results) < 2 and len(expanded_queries) > 1:
@@ -168,7 +265,8 @@ class SimpleAgent:
                         expanded_queries[1], 
                         k=k1, 
                         metadata_filter=classification['kb1_filter'], 
-                        score_threshold=score_threshold_kb1
+                        score_threshold=score_threshold_kb1,
+                        cache_hits=kb1_hits
                     )
                     existing = {getattr(d, 'page_content', '') for d in results}
                     for doc in results_expanded:
@@ -177,19 +275,20 @@ class SimpleAgent:
                 
                 return results
             except Exception as e:
-                print(f"[QDRANT]  Error en KB-1: {type(e).__name__}: {str(e)}")
+                logger.exception("Error en KB-1: %s: %s", type(e).__name__, e)
                 return []
         
         async def search_kb2():
             if not self.tool2:
-                print(f"[QDRANT]  KB-2: Herramienta no disponible")
+                logger.warning("KB-2: herramienta no disponible")
                 return []
             try:
                 results = await self.tool2(
                     main_query, 
                     k=k2, 
                     metadata_filter=classification['kb2_filter'], 
-                    score_threshold=score_threshold_kb2
+                    score_threshold=score_threshold_kb2,
+                    cache_hits=kb2_hits
                 )
                 
                 if len(results) < 2 and len(expanded_queries) > 1:
@@ -197,7 +296,8 @@ class SimpleAgent:
                         expanded_queries[1], 
                         k=k2, 
                         metadata_filter=classification['kb2_filter'], 
-                        score_threshold=score_threshold_kb2
+                        score_threshold=score_threshold_kb2,
+                        cache_hits=kb2_hits
                     )
                     existing = {getattr(d, 'page_content', '') for d in results}
                     for doc in results_expanded:
@@ -206,65 +306,48 @@ class SimpleAgent:
                 
                 return results
             except Exception as e:
-                print(f"[QDRANT]  Error en KB-2: {type(e).__name__}: {str(e)}")
+                logger.exception("Error en KB-2: %s: %s", type(e).__name__, e)
                 return []
         
-        docs1, docs2 = await asyncio.gather(search_kb1(), search_kb2(), return_exceptions=False)
+        with _stage(timings, 'retrieval'):
+            docs1, docs2 = await asyncio.gather(search_kb1(), search_kb2(), return_exceptions=False)
+        cache['kb1'] = _cache_state(kb1_hits)
+        cache['kb2'] = _cache_state(kb2_hits)
         
         if isinstance(docs1, Exception):
-            print(f"[QDRANT]  Excepción en KB-1: {docs1}")
+            logger.error("Excepción en KB-1: %s", docs1)
             docs1 = []
         if isinstance(docs2, Exception):
-            print(f"[QDRANT]  Excepción en KB-2: {docs2}")
+            logger.error("Excepción en KB-2: %s", docs2)
             docs2 = []
         
-        print(f"[QDRANT]  KB-1: Se encontraron {len(docs1)} documentos (ordenados por relevancia)")
-        for i, doc in enumerate(docs1, 1):
-            content = getattr(doc, 'page_content', '') or str(doc)
-            metadata = getattr(doc, 'metadata', {})
-            combined_score = metadata.get('score', 'N/A')
-            vector_score = metadata.get('vector_score', 'N/A')
-            term_score = metadata.get('term_score', 'N/A')
-            
-            if content:
-                preview = content[:300] + "..." if len(content) > 300 else content
-            else:
-                print(f"[QDRANT] KB-1 Doc #{i}:  CONTENIDO VACÍO\n")
-        
-        print(f"[QDRANT]  KB-2: Se encontraron {len(docs2)} documentos (ordenados por relevancia)")
-        for i, doc in enumerate(docs2, 1):
-            content = getattr(doc, 'page_content', '') or str(doc)
-            metadata = getattr(doc, 'metadata', {})
-            combined_score = metadata.get('score', 'N/A')
-            vector_score = metadata.get('vector_score', 'N/A')
-            term_score = metadata.get('term_score', 'N/A')
-            
-            if content:
-                preview = content[:300] + "..." if len(content) > 300 else content
-            else:
-                print(f"[QDRANT] KB-2 Doc #{i}:  CONTENIDO VACÍO\n")
-        
-        print(f"\n[QDRANT] Resumen: KB-1={len(docs1)} docs, KB-2={len(docs2)} docs\n")
-
-        kb1_context = self._format_docs(docs1)
-        kb2_context = self._format_docs(docs2)
-        history = self._format_history(recent)
+        # Se comprueba antes de construir los registros: en peticiones no
+        # muestreadas el filtro los descartaría igualmente
+        if diagnostics.isEnabledFor(logging.DEBUG) and diagnostics_sampled():
+            self._log_retrieved("KB-1", docs1)
+            self._log_retrieved("KB-2", docs2)
         
-        prompt = self.system_prompt_template.format(
-            kb1_desc=self.tool1_desc,
-            kb1_context=kb1_context,
-            kb2_desc=self.tool2_desc,
-            kb2_context=kb2_context,
-            history=history,
-            query=user_message
-        )
+        logger.info("Recuperación completada", extra={'kb1_docs': len(docs1), 'kb2_docs': len(docs2)})
 
-        reply = await self.llm.generate(prompt)
+        return classification, docs1, docs2
 
-        await self.memory.add_message(chat_id, "agent", reply)
+    def _log_retrieved(self, kb: str, docs: List[Any]) -> None:
+        for i, doc in enumerate(docs, 1):
+            content = getattr(doc, 'page_content', '') or str(doc)
+            if not content:
+                diagnostics.warning("%s doc #%d: contenido vacío", kb, i)
+                continue
+            diagnostics.debug(
+                "%s doc #%d", kb, i,
+                extra={
+                    'point_id': getattr(doc, 'id', None),
+                    'score': getattr(doc, 'score', None),
+                    'vector_score': getattr(doc, 'vector_score', None),
+                    'term_score': getattr(doc, 'term_score', None),
+                    'preview': content[:300] + "..." if len(content) > 300 else content,
+                }
+            )
 
-        return reply
-    
     def _format_docs(self, docs: List[Any]) -> str:
         if not docs:
             return "(Sin información relevante)"
@@ -15,10 +15,39 @@ class Settings:
     QDRANT_COLLECTION_1 = os.getenv("QDRANT_COLLECTION_1")  
     QDRANT_COLLECTION_2 = os.getenv("QDRANT_COLLECTION_2")  
     
+    RETRIEVAL_CACHE_MAX_BYTES = int(os.getenv("RETRIEVAL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    RETRIEVAL_CACHE_VERSION_TTL = float(os.getenv("RETRIEVAL_CACHE_VERSION_TTL", "30"))
+    # Edad máxima de una entrada; respaldo para re-ingestas que no cambian la versión
+    RETRIEVAL_CACHE_ENTRY_TTL = float(os.getenv("RETRIEVAL_CACHE_ENTRY_TTL", "600"))
+    
+    CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+    CHAT_BATCH_RETRIEVAL_WINDOW = float(os.getenv("CHAT_BATCH_RETRIEVAL_WINDOW", "0.005"))
+    
     SERVER_HOST = os.getenv("SERVER_HOST")
-    SERVER_PORT = int(os.getenv("SERVER_PORT"))
+    SERVER_PORT = int(os.getenv("SERVER_PORT", "5678"))
+    SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+    SERVER_RELOAD = os.getenv("SERVER_RELOAD", "true" if STATUS != "production" else "false").lower() == "true"
+    SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+    
+    # Presupuesto total de conexiones a PostgreSQL, repartido entre workers
+    POSTGRES_POOL_TOTAL = int(os.getenv("POSTGRES_POOL_TOTAL", "20"))
+    POSTGRES_POOL_MIN = int(os.getenv("POSTGRES_POOL_MIN", "2"))
+    # Cierre del pool al apagar, después del drenaje de uvicorn (SHUTDOWN_DRAIN_TIMEOUT)
+    POSTGRES_POOL_CLOSE_TIMEOUT = float(os.getenv("POSTGRES_POOL_CLOSE_TIMEOUT", "5"))
+    
+    CORS_ORIGINS = os.getenv("CORS_ORIGINS", "").split(",") 
+    
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json" if STATUS == "production" else "text")
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    # Detalle de recuperación (documentos y scores por KB): nivel y fracción de peticiones
+    LOG_DIAGNOSTICS_LEVEL = os.getenv("LOG_DIAGNOSTICS_LEVEL", "DEBUG" if STATUS != "production" else "WARNING")
+    LOG_DIAGNOSTICS_SAMPLE_RATE = float(os.getenv("LOG_DIAGNOSTICS_SAMPLE_RATE", "1.0"))
     
-    CORS_ORIGINS = os.getenv("CORS_ORIGINS").split(",") 
+    # Grabación de trazas para replay.py; vacío = desactivado. Admite {pid} para
+    # un fichero por worker.
+    TRACE_RECORD_PATH = os.getenv("TRACE_RECORD_PATH", "")
+    TRACE_RECORD_SAMPLE_RATE = float(os.getenv("TRACE_RECORD_SAMPLE_RATE", "1.0"))
 
 
 settings = Settings()
@@ -1,16 +1,44 @@
-from typing import Optional
-from fastapi import FastAPI, HTTPException
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_openai import OpenAIEmbeddings
+from fastapi.responses import StreamingResponse
 
 from config import settings
-from models import ChatRequest, ChatResponse
-from memory import PostgresChatMemory
-from utils import GeminiClient
-from tools import init_qdrant_client, create_retrieval_tool_from_collection
+from models import ChatRequest, ChatResponse, ChatBatchRequest, ChatBatchResult
+from memory import PostgresChatMemory, run_migrations, decode_cursor
+from tools import (
+    init_qdrant_client,
+    create_retrieval_tool_from_collection,
+    configure_retrieval_cache,
+    get_retrieval_cache_stats,
+    RetrievalBatcher,
+)
 from agents import SimpleAgent
-from utils.openai_client import OpenAIClient
+from utils.providers import build_llm, build_embeddings, import_provider_modules
+from utils.trace_recorder import TraceRecorder
+from utils.log import setup_logging, shutdown_logging, set_trace_id, get_trace_id, trace_context, get_logging_stats
+
+# Los SDKs de proveedores (Gemini, OpenAI, Qdrant) se importan de forma diferida
+# en bootstrap según STATUS. Para un desglose: python -X importtime main.py
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
+setup_logging(
+    level=settings.LOG_LEVEL,
+    fmt=settings.LOG_FORMAT,
+    diagnostics_level=settings.LOG_DIAGNOSTICS_LEVEL,
+    diagnostics_sample_rate=settings.LOG_DIAGNOSTICS_SAMPLE_RATE,
+    queue_size=settings.LOG_QUEUE_SIZE
+)
+logger = logging.getLogger(__name__)
 
 
 app = FastAPI(
@@ -28,66 +56,113 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def trace_id_middleware(request: Request, call_next):
+    # Trace ID por petición (se respeta X-Request-ID si el cliente lo envía);
+    # viaja en un ContextVar hasta el agente, la memoria y las herramientas.
+    trace_id = set_trace_id(request.headers.get("X-Request-ID"))
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = trace_id
+    return response
+
+
 _agent: Optional[SimpleAgent] = None
 _memory: Optional[PostgresChatMemory] = None
+_qdrant = None
+_recorder: Optional[TraceRecorder] = None
 
+_PROVIDER_MODULES = (
+    "langchain_google_genai",
+    "langchain_openai",
+    "openai",
+    "qdrant_client",
+)
+_startup_report: Dict[str, Any] = {
+    "import_seconds": round(_IMPORT_SECONDS, 4),
+    "bootstrap_seconds": None,
+    "steps": {},
+    "provider_imports": {},
+    "provider_modules": [],
+}
 
-async def bootstrap() -> None:
+# El proceso padre exporta esta variable tras ejecutar las migraciones, para que
+# cada worker arranque sin repetir CREATE TABLE ni COUNT(*).
+SCHEMA_READY_ENV = "CHAT_SCHEMA_READY"
 
-    global _agent, _memory
 
-    print("[BOOTSTRAP] Inicializando conexión a PostgreSQL...")
-    if not settings.POSTGRES_CONNECTION_STRING:
-        print("[BOOTSTRAP] POSTGRES_CONNECTION_STRING no configurada")
-        _memory = None
-    else:
-        try:
-            _memory = PostgresChatMemory(settings.POSTGRES_CONNECTION_STRING)
-            await _memory.init()
-            print("[BOOTSTRAP]  Memoria PostgreSQL inicializada correctamente")
-        except Exception as e:
-            print(f"[BOOTSTRAP]  Error inicializando PostgreSQL: {type(e).__name__}: {str(e)}")
-            _memory = None
+def _pool_sizes() -> tuple:
+    workers = max(settings.SERVER_WORKERS, 1)
+    if workers > settings.POSTGRES_POOL_TOTAL:
+        # __main__ no arranca así; esto cubre lanzamientos externos (uvicorn --workers)
+        logger.error(
+            "SERVER_WORKERS=%d supera POSTGRES_POOL_TOTAL=%d: cada worker usará 1 conexión (%d en total)",
+            workers, settings.POSTGRES_POOL_TOTAL, workers
+        )
+    max_size = max(1, settings.POSTGRES_POOL_TOTAL // workers)
+    min_size = min(settings.POSTGRES_POOL_MIN, max_size)
+    return min_size, max_size
 
-    llm = None
-    if settings.GEMINI_API_KEY and settings.STATUS == "production":
-        try:
-            gemini_client = GeminiClient(settings.GEMINI_API_KEY)
-            llm = gemini_client
-            print("[BOOTSTRAP]  Cliente Gemini inicializado correctamente")
-        except Exception as e:
-            print(f"[BOOTSTRAP]  No se pudo inicializar Gemini client: {e}")
-    
-    else:
-        try:
-            openai_client = OpenAIClient(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_URL)
-            llm = openai_client
-            print("[BOOTSTRAP]  Cliente OpenAI inicializado correctamente")
-        except Exception as e:
-            print(f"[BOOTSTRAP]  No se pudo inicializar OpenAI client: {e}")
 
-    q_client = init_qdrant_client(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
-    embeddings = None
+async def _timed(name: str, awaitable):
+    started = time.perf_counter()
     try:
-        if settings.STATUS == "production" and settings.GEMINI_API_KEY:
-            embeddings = GoogleGenerativeAIEmbeddings(
-                model="models/text-embedding-004",
-                google_api_key=settings.GEMINI_API_KEY
-            )
-            print("[BOOTSTRAP]  Embeddings de Gemini inicializados correctamente")
-        else:
-            print("[BOOTSTRAP]  Usando embeddings de OpenAI local para entorno de desarrollo")
-            embeddings = OpenAIEmbeddings(
-                model="text-embedding-multilingual-e5-large-instruct",
-                openai_api_key=settings.OPENAI_API_KEY,
-                openai_api_base=settings.OPENAI_URL,
-                check_embedding_ctx_length=False  # Desactiva validación de longitud
-            )
+        return await awaitable
+    finally:
+        _startup_report["steps"][name] = round(time.perf_counter() - started, 4)
+
+
+async def _init_memory() -> Optional[PostgresChatMemory]:
+    logger.info("Inicializando conexión a PostgreSQL...")
+    if not settings.POSTGRES_CONNECTION_STRING:
+        logger.warning("POSTGRES_CONNECTION_STRING no configurada")
+        return None
+    try:
+        min_size, max_size = _pool_sizes()
+        memory = PostgresChatMemory(
+            settings.POSTGRES_CONNECTION_STRING,
+            min_size=min_size,
+            max_size=max_size
+        )
+        await memory.init(ensure_schema=os.getenv(SCHEMA_READY_ENV) != "1")
+        logger.info("Memoria PostgreSQL inicializada correctamente")
+        return memory
     except Exception as e:
-        print(f"[BOOTSTRAP]  Error inicializando embeddings: {e}")
-        import traceback
-        traceback.print_exc()
-        embeddings = None
+        logger.error("Error inicializando PostgreSQL: %s: %s", type(e).__name__, e)
+        return None
+
+
+def _build_qdrant():
+    return init_qdrant_client(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
+
+
+async def bootstrap() -> None:
+
+    global _agent, _memory, _qdrant, _recorder
+
+    bootstrap_started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    configure_retrieval_cache(
+        max_bytes=settings.RETRIEVAL_CACHE_MAX_BYTES,
+        version_ttl=settings.RETRIEVAL_CACHE_VERSION_TTL,
+        entry_ttl=settings.RETRIEVAL_CACHE_ENTRY_TTL
+    )
+
+    # PostgreSQL arranca ya en el loop. Los imports de los SDKs van en serie en
+    # un solo hilo del executor (en paralelo se pisan en importlib); después
+    # solo los constructores, que hacen E/S, corren en paralelo.
+    memory_task = asyncio.ensure_future(_timed("postgres", _init_memory()))
+    _startup_report["provider_imports"] = await _timed(
+        "provider_imports",
+        loop.run_in_executor(None, import_provider_modules)
+    )
+    llm, q_client, embeddings = await asyncio.gather(
+        _timed("llm", loop.run_in_executor(None, build_llm)),
+        _timed("qdrant", loop.run_in_executor(None, _build_qdrant)),
+        _timed("embeddings", loop.run_in_executor(None, build_embeddings)),
+    )
+    _memory = await memory_task
+    _qdrant = q_client
 
     tool1 = None
     tool2 = None
@@ -95,16 +170,19 @@ async def bootstrap() -> None:
     tool2_desc = "Contiene: Tarifas de Alquiler, Precios por Categoría, Disponibilidad de Modelos, Ubicaciones de Oficinas, Datos Operacionales de Flota, Información Logística."
     
     if q_client and embeddings:
-        tool1 = create_retrieval_tool_from_collection(
-            settings.QDRANT_COLLECTION_1, 
-            q_client, 
-            embeddings
-        )
-        tool2 = create_retrieval_tool_from_collection(
-            settings.QDRANT_COLLECTION_2, 
-            q_client, 
-            embeddings
-        )
+        # Sin E/S: solo prepara las closures de búsqueda
+        tool1 = create_retrieval_tool_from_collection(settings.QDRANT_COLLECTION_1, q_client, embeddings)
+        tool2 = create_retrieval_tool_from_collection(settings.QDRANT_COLLECTION_2, q_client, embeddings)
+
+    if settings.TRACE_RECORD_PATH and _recorder is None:
+        try:
+            _recorder = TraceRecorder(
+                settings.TRACE_RECORD_PATH.replace("{pid}", str(os.getpid())),
+                sample_rate=settings.TRACE_RECORD_SAMPLE_RATE
+            )
+        except Exception as e:
+            logger.error("No se pudo abrir TRACE_RECORD_PATH, grabación desactivada: %s: %s", type(e).__name__, e)
+            _recorder = None
 
     if llm and _memory:
         _agent = SimpleAgent(
@@ -113,11 +191,16 @@ async def bootstrap() -> None:
             tool1=tool1, 
             tool2=tool2, 
             tool1_desc=tool1_desc, 
-            tool2_desc=tool2_desc
+            tool2_desc=tool2_desc,
+            recorder=_recorder
         )
-        print("[BOOTSTRAP]  Agente SimpleAgent inicializado correctamente")
+        logger.info("Agente SimpleAgent inicializado correctamente")
     else:
-        print("[BOOTSTRAP]  AVISO: Agente no inicializado completamente. Revisa GEMINI_API_KEY y POSTGRES_CONNECTION_STRING.")
+        logger.warning("Agente no inicializado completamente. Revisa GEMINI_API_KEY y POSTGRES_CONNECTION_STRING.")
+
+    _startup_report["bootstrap_seconds"] = round(time.perf_counter() - bootstrap_started, 4)
+    _startup_report["provider_modules"] = sorted(m for m in _PROVIDER_MODULES if m in sys.modules)
+    logger.info("Arranque completado", extra={'startup': _startup_report})
 
 @app.on_event("startup")
 async def on_startup():
@@ -125,6 +208,31 @@ async def on_startup():
     await bootstrap()
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+
+    # uvicorn ya dejó de aceptar conexiones y esperó a las peticiones en curso
+    # (timeout_graceful_shutdown); aquí se liberan los recursos del worker, con
+    # un timeout corto propio para no esperar el drenaje una segunda vez.
+    global _agent, _memory, _qdrant, _recorder
+    _agent = None
+    if _memory is not None:
+        await _memory.close(timeout=settings.POSTGRES_POOL_CLOSE_TIMEOUT)
+        _memory = None
+    if _qdrant is not None:
+        try:
+            _qdrant.close()
+            logger.info("Cliente Qdrant cerrado")
+        except Exception as e:
+            logger.error("Error cerrando cliente Qdrant: %s: %s", type(e).__name__, e)
+        _qdrant = None
+    if _recorder is not None:
+        # join del hilo escritor fuera del event loop
+        await asyncio.get_running_loop().run_in_executor(None, _recorder.close)
+        _recorder = None
+    shutdown_logging()
+
+
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
@@ -143,17 +251,85 @@ async def chat_endpoint(request: ChatRequest):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[CHAT] ERROR: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error en /chat: %s: %s", type(e).__name__, e)
         raise HTTPException(
             status_code=500, 
             detail=f"Error procesando mensaje: {str(e)}"
         )
 
 
+@app.post("/chat/batch")
+async def chat_batch_endpoint(request: ChatBatchRequest):
+
+    if _agent is None:
+        raise HTTPException(
+            status_code=503, 
+            detail="El servicio no está disponible. El agente no está inicializado."
+        )
+
+    # Mensajes del mismo chat_id se procesan en orden; chats distintos en paralelo
+    by_chat: "OrderedDict[str, List[Tuple[int, ChatRequest]]]" = OrderedDict()
+    for index, item in enumerate(request.requests):
+        by_chat.setdefault(item.chat_id, []).append((index, item))
+
+    semaphore = asyncio.Semaphore(max(settings.CHAT_BATCH_CONCURRENCY, 1))
+    results: asyncio.Queue = asyncio.Queue()
+
+    parent_trace_id = get_trace_id()
+
+    # Las herramientas agrupadas comparten embeddings y búsquedas en Qdrant
+    # entre las ejecuciones concurrentes de este lote.
+    batcher = RetrievalBatcher(window=settings.CHAT_BATCH_RETRIEVAL_WINDOW, trace_id=parent_trace_id)
+    agent = _agent.with_tools(batcher.wrap(_agent.tool1), batcher.wrap(_agent.tool2))
+
+    async def process_chat(items: List[Tuple[int, ChatRequest]]) -> None:
+        for index, item in items:
+            async with semaphore:
+                with trace_context(f"{parent_trace_id}-{index}"):
+                    result = await process_one(index, item)
+            await results.put(result)
+
+    async def process_one(index: int, item: ChatRequest) -> ChatBatchResult:
+        try:
+            reply = await agent.run(item.chat_id, item.message)
+            return ChatBatchResult(index=index, chat_id=item.chat_id, response=reply)
+        except Exception as e:
+            logger.exception("Error en lote #%d (%s): %s: %s", index, item.chat_id, type(e).__name__, e)
+            return ChatBatchResult(
+                index=index,
+                chat_id=item.chat_id,
+                error=f"Error procesando mensaje: {str(e)}"
+            )
+
+    async def stream():
+        tasks = [asyncio.create_task(process_chat(items)) for items in by_chat.values()]
+        try:
+            for _ in range(len(request.requests)):
+                result = await results.get()
+                yield result.model_dump_json() + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            logger.info(
+                "Lote procesado",
+                extra={
+                    'messages': len(request.requests),
+                    'chats': len(by_chat),
+                    'retrieval_flushes': batcher.flushes,
+                    'embedded_texts': batcher.embedded_texts,
+                }
+            )
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 @app.get("/chat/{chat_id}/history")
-async def get_chat_history(chat_id: str, limit: int = 10):
+async def get_chat_history(
+    chat_id: str, 
+    limit: int = Query(10, ge=1, le=1000), 
+    cursor: Optional[str] = None, 
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
     
     try:
         if _memory is None:
@@ -162,18 +338,62 @@ async def get_chat_history(chat_id: str, limit: int = 10):
                 detail="El servicio de memoria no está disponible."
             )
         
-        history = await _memory.get_recent(chat_id, limit=limit)
+        if format == "ndjson":
+            # Exportación completa en streaming: una línea JSON por mensaje. La
+            # primera fila se lee antes de responder, así un fallo de conexión o
+            # de consulta todavía devuelve 500 en lugar de un 200 vacío.
+            messages = _memory.iter_messages(chat_id)
+            try:
+                first = await messages.__anext__()
+            except StopAsyncIteration:
+                first = None
+
+            def to_line(message: Dict[str, Any]) -> str:
+                message["created_at"] = message["created_at"].isoformat() if message["created_at"] else None
+                return json.dumps(message, ensure_ascii=False) + "\n"
+
+            async def export():
+                count = 0
+                try:
+                    if first is not None:
+                        count += 1
+                        yield to_line(first)
+                        async for message in messages:
+                            count += 1
+                            yield to_line(message)
+                except Exception as e:
+                    # La respuesta ya empezó: se cierra con una línea de error
+                    # explícita para que la exportación no parezca completa.
+                    logger.exception(
+                        "Error exportando historial: %s: %s", type(e).__name__, e,
+                        extra={'chat_id': chat_id, 'messages': count}
+                    )
+                    yield json.dumps({"error": f"Exportación incompleta: {str(e)}", "exported": count}, ensure_ascii=False) + "\n"
+                    return
+                finally:
+                    await messages.aclose()
+                logger.info("Historial exportado", extra={'chat_id': chat_id, 'messages': count})
+
+            return StreamingResponse(export(), media_type="application/x-ndjson")
+        
+        # Se decodifica fuera de get_page: un cursor inválido no debe reintentarse
+        before = None
+        if cursor:
+            try:
+                before = decode_cursor(cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        
+        history, next_cursor = await _memory.get_page(chat_id, limit=limit, before=before)
         
-        print(f"[HISTORY] Recuperados {len(history)} mensajes para {chat_id}")
+        logger.info("Historial recuperado", extra={'chat_id': chat_id, 'messages': len(history)})
         
-        return {"chat_id": chat_id, "history": history}
+        return {"chat_id": chat_id, "history": history, "next_cursor": next_cursor}
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[HISTORY] ERROR: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error obteniendo historial: %s: %s", type(e).__name__, e)
         raise HTTPException(
             status_code=500, 
             detail=f"Error obteniendo historial: {str(e)}"
@@ -202,7 +422,7 @@ async def health_check():
         
     try:
         if _agent and _agent.tool1:
-            await _agent.tool1("test", k=1)
+            await _agent.tool1("test", k=1, use_cache=False)
             health_status["checks"]["qdrant"] = True
     except Exception:
         health_status["checks"]["qdrant"] = False
@@ -212,12 +432,61 @@ async def health_check():
     return JSONResponse(content=health_status, status_code=status_code)
 
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "retrieval_cache": get_retrieval_cache_stats(),
+        "startup": _startup_report,
+        "logging": get_logging_stats(),
+        "trace_recorder": _recorder.stats() if _recorder else None,
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     
-    uvicorn.run(
-        "main:app", 
-        host=settings.SERVER_HOST, 
-        port=settings.SERVER_PORT, 
-        reload=True
-    )
+    workers = max(settings.SERVER_WORKERS, 1)
+    
+    if settings.POSTGRES_CONNECTION_STRING and workers > settings.POSTGRES_POOL_TOTAL:
+        logger.error(
+            "SERVER_WORKERS=%d supera POSTGRES_POOL_TOTAL=%d; reduce los workers o sube el presupuesto",
+            workers, settings.POSTGRES_POOL_TOTAL
+        )
+        shutdown_logging()
+        sys.exit(1)
+    
+    if workers == 1 and settings.SERVER_RELOAD:
+        uvicorn.run(
+            "main:app", 
+            host=settings.SERVER_HOST, 
+            port=settings.SERVER_PORT, 
+            reload=True
+        )
+    else:
+        # Modo multi-worker: migraciones una sola vez en el proceso padre y
+        # cada worker construye sus propios clientes (shared-nothing).
+        if settings.POSTGRES_CONNECTION_STRING:
+            try:
+                asyncio.run(run_migrations(settings.POSTGRES_CONNECTION_STRING))
+                os.environ[SCHEMA_READY_ENV] = "1"
+            except Exception as e:
+                logger.error("Migraciones fallidas, cada worker lo reintentará: %s: %s", type(e).__name__, e)
+        
+        # Varios workers escribiendo en el mismo fichero intercalan líneas: cada
+        # uno graba en el suyo. Los workers heredan el entorno del padre.
+        if workers > 1 and settings.TRACE_RECORD_PATH and "{pid}" not in settings.TRACE_RECORD_PATH:
+            root, ext = os.path.splitext(settings.TRACE_RECORD_PATH)
+            trace_path = f"{root}.{{pid}}{ext}"
+            logger.warning("TRACE_RECORD_PATH sin {pid} con %d workers; se usará %s", workers, trace_path)
+            os.environ["TRACE_RECORD_PATH"] = trace_path
+        
+        min_size, max_size = _pool_sizes()
+        logger.info("Lanzando %d workers", workers, extra={'pool_min': min_size, 'pool_max': max_size})
+        
+        uvicorn.run(
+            "main:app", 
+            host=settings.SERVER_HOST, 
+            port=settings.SERVER_PORT, 
+            workers=workers,
+            timeout_graceful_shutdown=settings.SHUTDOWN_DRAIN_TIMEOUT
+        )
@@ -1,3 +1,3 @@
-from .postgres_memory import PostgresChatMemory
+from .postgres_memory import PostgresChatMemory, run_migrations, decode_cursor
 
-__all__ = ['PostgresChatMemory']
+__all__ = ['PostgresChatMemory', 'run_migrations', 'decode_cursor']
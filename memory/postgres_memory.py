@@ -1,51 +1,143 @@
-from typing import Dict, List, Optional
+import asyncio
+import base64
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from tenacity import retry, stop_after_attempt, wait_exponential
 try:
     import asyncpg
 except Exception:  
     asyncpg = None
 
+logger = logging.getLogger(__name__)
+
+
+async def _ensure_schema(conn) -> None:
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages_web (
+            id SERIAL PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """
+    )
+    # Tablas creadas antes sin NOT NULL: la paginación por keyset necesita
+    # created_at en todas las filas (NULL no entra en la comparación y no se
+    # puede codificar en el cursor). Las filas sin fecha pasan a ser las más
+    # antiguas.
+    nullable = await conn.fetchval(
+        """
+        SELECT is_nullable = 'YES' FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'chat_messages_web' AND column_name = 'created_at'
+        """
+    )
+    if nullable:
+        async with conn.transaction():
+            updated = await conn.execute(
+                "UPDATE chat_messages_web SET created_at = to_timestamp(0) WHERE created_at IS NULL"
+            )
+            await conn.execute("ALTER TABLE chat_messages_web ALTER COLUMN created_at SET NOT NULL")
+        logger.info("created_at pasa a NOT NULL (%s)", updated)
+    # Índice para la paginación por keyset (chat_id, created_at, id)
+    await conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS chat_messages_web_chat_created_id_idx
+        ON chat_messages_web (chat_id, created_at, id);
+        """
+    )
+
+
+def encode_cursor(created_at: datetime, message_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{message_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, message_id = base64.urlsafe_b64decode(padded).decode("utf-8").rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except Exception:
+        raise ValueError(f"Cursor inválido: {cursor!r}")
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
+async def run_migrations(dsn: str) -> None:
+    # Paso único previo a lanzar los workers: esquema y conteo inicial se hacen
+    # una sola vez con una conexión suelta, sin crear pool.
+    if asyncpg is None:
+        raise RuntimeError("`asyncpg` no está instalado. Instala asyncpg para usar PostgresChatMemory.")
+    if not dsn:
+        raise RuntimeError("POSTGRES_CONNECTION_STRING no configurada.")
+    conn = await asyncpg.connect(dsn)
+    try:
+        await _ensure_schema(conn)
+        result = await conn.fetchval("SELECT COUNT(*) FROM chat_messages_web")
+        logger.info("Mensajes en base de datos: %s", result)
+    finally:
+        await conn.close()
+
 
 class PostgresChatMemory:
 
-    def __init__(self, dsn: str):
+    def __init__(self, dsn: str, min_size: int = 10, max_size: int = 10, max_exports: Optional[int] = None):
         if asyncpg is None:
             raise RuntimeError("`asyncpg` no está instalado. Instala asyncpg para usar PostgresChatMemory.")
         if not dsn:
             raise RuntimeError("POSTGRES_CONNECTION_STRING no configurada.")
         self._dsn = dsn
+        self._min_size = min(min_size, max_size)
+        self._max_size = max_size
         self._pool: Optional[asyncpg.Pool] = None
+        # Una exportación retiene una conexión del pool mientras el cliente
+        # descarga; se limitan para que siempre queden conexiones para /chat.
+        if max_exports is None:
+            max_exports = max(1, max_size // 2)
+        self._max_exports = max_exports
+        self._export_slots = asyncio.Semaphore(max_exports)
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
-    async def init(self) -> None:
+    async def init(self, ensure_schema: bool = True) -> None:
         if self._pool:
-            print("[POSTGRES] Pool de conexiones ya inicializado")
+            logger.debug("Pool de conexiones ya inicializado")
             return
         
-        print(f"[POSTGRES] Conectando a PostgreSQL...")
-        print(f"[POSTGRES] DSN: {self._dsn[:50]}...")
+        logger.info("Conectando a PostgreSQL (DSN: %s...)", self._dsn[:50])
         
         try:
-            self._pool = await asyncpg.create_pool(self._dsn)
+            self._pool = await asyncpg.create_pool(
+                self._dsn,
+                min_size=self._min_size,
+                max_size=self._max_size,
+            )
+            logger.info(
+                "Pool creado",
+                extra={'pool_min': self._min_size, 'pool_max': self._max_size, 'max_exports': self._max_exports}
+            )
             
-            async with self._pool.acquire() as conn:
-                await conn.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS chat_messages_web (
-                        id SERIAL PRIMARY KEY,
-                        chat_id TEXT NOT NULL,
-                        role TEXT NOT NULL,
-                        content TEXT NOT NULL,
-                        created_at TIMESTAMPTZ DEFAULT NOW()
-                    );
-                    """
-                )                
-                result = await conn.fetchval("SELECT COUNT(*) FROM chat_messages_web")
-                print(f"[POSTGRES]  Mensajes en base de datos: {result}")
+            if ensure_schema:
+                async with self._pool.acquire() as conn:
+                    await _ensure_schema(conn)
         except Exception as e:
-            print(f"[POSTGRES] Error al conectar: {type(e).__name__}: {str(e)}")
+            logger.error("Error al conectar: %s: %s", type(e).__name__, e)
             raise
 
+    async def close(self, timeout: float = 10.0) -> None:
+        if not self._pool:
+            return
+        pool, self._pool = self._pool, None
+        try:
+            # close() espera a que se liberen las conexiones en uso
+            await asyncio.wait_for(pool.close(), timeout=timeout)
+            logger.info("Pool de conexiones cerrado")
+        except asyncio.TimeoutError:
+            logger.warning("Timeout de %ss cerrando el pool; terminando conexiones", timeout)
+            pool.terminate()
+
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
     async def add_message(self, chat_id: str, role: str, content: str) -> None:
         if not self._pool:
@@ -59,7 +151,7 @@ class PostgresChatMemory:
                     role,
                     content,
                 )
-                print(f"[POSTGRES]  Mensaje guardado exitosamente")
+                logger.debug("Mensaje guardado", extra={'chat_id': chat_id, 'role': role})
         except Exception as e:
             raise
 
@@ -74,3 +166,53 @@ class PostgresChatMemory:
                 limit,
             )
         return [dict(row) for row in reversed(rows)]
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
+    async def get_page(
+        self, 
+        chat_id: str, 
+        limit: int = 50, 
+        before: Optional[Tuple[datetime, int]] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        # Página de mensajes anteriores a `before` (cursor ya decodificado con
+        # decode_cursor, o None para los más recientes), en orden cronológico,
+        # y el cursor de la página siguiente.
+        if not self._pool:
+            await self.init()
+        params: List[Any] = [chat_id]
+        condition = ""
+        if before:
+            created_at, message_id = before
+            params.extend([created_at, message_id])
+            condition = "AND (created_at, id) < ($2, $3)"
+        params.append(limit + 1)
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"""
+                SELECT id, role, content, created_at FROM chat_messages_web
+                WHERE chat_id=$1 {condition}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ${len(params)}
+                """,
+                *params,
+            )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_more else None
+        return [dict(row) for row in reversed(rows)], next_cursor
+
+    async def iter_messages(self, chat_id: str, prefetch: int = 500) -> AsyncIterator[Dict[str, Any]]:
+        # Recorre toda la conversación con un cursor del lado del servidor:
+        # solo `prefetch` filas en memoria a la vez, sin importar su tamaño.
+        # Como mucho `max_exports` a la vez; las demás esperan turno.
+        if not self._pool:
+            await self.init()
+        async with self._export_slots, self._pool.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                async for row in conn.cursor(
+                    "SELECT id, role, content, created_at FROM chat_messages_web "
+                    "WHERE chat_id=$1 ORDER BY created_at, id",
+                    chat_id,
+                    prefetch=prefetch,
+                ):
+                    yield dict(row)
@@ -1,3 +1,3 @@
-from .schemas import ChatRequest, ChatResponse
+from .schemas import ChatRequest, ChatResponse, ChatBatchRequest, ChatBatchResult
 
-__all__ = ['ChatRequest', 'ChatResponse']
+__all__ = ['ChatRequest', 'ChatResponse', 'ChatBatchRequest', 'ChatBatchResult']
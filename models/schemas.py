@@ -1,3 +1,4 @@
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 
@@ -9,4 +10,14 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     chat_id: str
     response: str
-    
\ No newline at end of file
+
+
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., min_length=1, max_length=200)
+
+
+class ChatBatchResult(BaseModel):
+    index: int
+    chat_id: str
+    response: Optional[str] = None
+    error: Optional[str] = None
@@ -0,0 +1,213 @@
+# Re-ejecuta trazas grabadas (TRACE_RECORD_PATH) contra el stack de recuperación
+# actual y compara, por consulta, la clasificación, los IDs recuperados en cada KB
+# (solapamiento Jaccard) y la latencia de recuperación frente a lo grabado.
+#
+#   python replay.py traces.jsonl
+#   python replay.py traces.jsonl --backend memory --seed puntos.jsonl --fake-embeddings 768
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import sys
+from typing import Any, Dict, List, Optional
+
+from config import settings
+from agents import SimpleAgent
+from tools import init_qdrant_client, create_retrieval_tool_from_collection, configure_retrieval_cache
+from utils.trace_recorder import read_records, summarize_docs
+
+
+def _jaccard(a: List[Any], b: List[Any]) -> float:
+    set_a = {hit[0] for hit in a}
+    set_b = {hit[0] for hit in b}
+    if not set_a and not set_b:
+        return 1.0
+    return len(set_a & set_b) / len(set_a | set_b)
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _build_embeddings(args):
+    if args.fake_embeddings:
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        return DeterministicFakeEmbedding(size=args.fake_embeddings)
+    from utils.providers import build_embeddings
+    return build_embeddings()
+
+
+def _seed_collections(client, embeddings, seed_path: str) -> None:
+    # Carga puntos {"collection", "id", "text"} en un Qdrant embebido
+    from qdrant_client import models
+
+    by_collection: Dict[str, List[Dict[str, Any]]] = {}
+    for point in read_records(seed_path):
+        by_collection.setdefault(point["collection"], []).append(point)
+
+    for collection, points in by_collection.items():
+        vectors = embeddings.embed_documents([p["text"] for p in points])
+        if not client.collection_exists(collection):
+            client.create_collection(
+                collection,
+                vectors_config=models.VectorParams(size=len(vectors[0]), distance=models.Distance.COSINE)
+            )
+        client.upsert(collection, points=[
+            models.PointStruct(id=p["id"], vector=vector, payload={"text": p["text"], "metadata": {}})
+            for p, vector in zip(points, vectors)
+        ])
+        print(f"[REPLAY] {len(points)} puntos cargados en '{collection}'", file=sys.stderr)
+
+
+def _build_qdrant(args, embeddings):
+    if args.backend == "live":
+        return init_qdrant_client(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
+
+    from qdrant_client import QdrantClient
+    client = QdrantClient(location=":memory:") if args.qdrant_path == ":memory:" else QdrantClient(path=args.qdrant_path)
+    if args.seed:
+        _seed_collections(client, embeddings, args.seed)
+    return client
+
+
+async def replay(args) -> int:
+    if not args.with_cache:
+        configure_retrieval_cache(max_bytes=0, version_ttl=settings.RETRIEVAL_CACHE_VERSION_TTL)
+
+    embeddings = _build_embeddings(args)
+    client = _build_qdrant(args, embeddings)
+    if client is None or embeddings is None:
+        print("[REPLAY] No se pudo construir Qdrant o embeddings", file=sys.stderr)
+        return 1
+
+    agent = SimpleAgent(
+        llm=None,
+        memory=None,
+        tool1=create_retrieval_tool_from_collection(settings.QDRANT_COLLECTION_1, client, embeddings),
+        tool2=create_retrieval_tool_from_collection(settings.QDRANT_COLLECTION_2, client, embeddings),
+    )
+
+    results = []
+    read_stats: Dict[str, int] = {}
+    for index, record in enumerate(read_records(args.traces, read_stats)):
+        if args.limit and index >= args.limit:
+            break
+        timings: Dict[str, float] = {}
+        cache: Dict[str, Optional[str]] = {}
+        classification, docs1, docs2 = await agent.retrieve(record["query"], timings, cache)
+        kb1, kb2 = summarize_docs(docs1), summarize_docs(docs2)
+        recorded_ms = record.get("ms", {}).get("retrieval")
+        # Un acierto de cache grabado frente a una búsqueda en frío (o al revés)
+        # no dice nada de una regresión: el delta solo se calcula si ambos lados
+        # se sirvieron igual. Trazas antiguas sin "cache" se comparan con aviso.
+        recorded_cache = record.get("cache") or None
+        if recorded_cache is None:
+            latency = "unknown"
+        elif recorded_cache == cache:
+            latency = "comparable"
+        else:
+            latency = "cache_mismatch"
+        result = {
+            "query": record["query"],
+            "classification_changed": classification.get("prioritize") != record["cls"]["prioritize"],
+            "kb1_overlap": round(_jaccard(record["kb1"], kb1), 4),
+            "kb2_overlap": round(_jaccard(record["kb2"], kb2), 4),
+            "recorded_ms": recorded_ms,
+            "replay_ms": timings.get("retrieval"),
+            "recorded_cache": recorded_cache,
+            "replay_cache": cache,
+            "latency": latency,
+            "delta_ms": (
+                round(timings["retrieval"] - recorded_ms, 2)
+                if recorded_ms is not None and latency != "cache_mismatch" else None
+            ),
+        }
+        results.append(result)
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False))
+
+    if not results:
+        print("[REPLAY] Sin trazas para reproducir", file=sys.stderr)
+        return 1
+
+    deltas = [r["delta_ms"] for r in results if r["delta_ms"] is not None]
+    replay_ms = [r["replay_ms"] for r in results]
+    recorded_ms = [r["recorded_ms"] for r in results if r["recorded_ms"] is not None]
+    latency_mismatched = sum(r["latency"] == "cache_mismatch" for r in results)
+    latency_unknown = sum(r["latency"] == "unknown" for r in results)
+    if latency_mismatched:
+        print(
+            f"[REPLAY] {latency_mismatched} consultas excluidas del delta de latencia: la traza y el replay "
+            "difieren en aciertos de cache (usa --with-cache o graba con RETRIEVAL_CACHE_MAX_BYTES=0)",
+            file=sys.stderr
+        )
+    if latency_unknown:
+        print(
+            f"[REPLAY] {latency_unknown} trazas sin estado de cache: su delta de latencia puede comparar "
+            "aciertos de cache con búsquedas en frío",
+            file=sys.stderr
+        )
+    summary = {
+        "queries": len(results),
+        "malformed_lines": read_stats.get("malformed", 0),
+        "classification_changes": sum(r["classification_changed"] for r in results),
+        "kb1_overlap_mean": round(statistics.mean(r["kb1_overlap"] for r in results), 4),
+        "kb2_overlap_mean": round(statistics.mean(r["kb2_overlap"] for r in results), 4),
+        "recorded_ms_p50": _percentile(recorded_ms, 50),
+        "recorded_ms_p95": _percentile(recorded_ms, 95),
+        "replay_ms_p50": _percentile(replay_ms, 50),
+        "replay_ms_p95": _percentile(replay_ms, 95),
+        "delta_ms_mean": round(statistics.mean(deltas), 2) if deltas else None,
+        "latency_compared": len(deltas),
+        "latency_cache_mismatch": latency_mismatched,
+        "latency_cache_unknown": latency_unknown,
+    }
+
+    if args.json:
+        print(json.dumps({"summary": summary}, ensure_ascii=False))
+        return 0
+
+    print(f"Consultas reproducidas:    {summary['queries']}")
+    if summary['malformed_lines']:
+        print(f"Líneas malformadas:        {summary['malformed_lines']} (omitidas)")
+    print(f"Cambios de clasificación:  {summary['classification_changes']}")
+    print(f"Solapamiento medio KB-1:   {summary['kb1_overlap_mean']:.2%}")
+    print(f"Solapamiento medio KB-2:   {summary['kb2_overlap_mean']:.2%}")
+    print(f"Recuperación grabada ms:   p50={summary['recorded_ms_p50']} p95={summary['recorded_ms_p95']}")
+    print(f"Recuperación replay ms:    p50={summary['replay_ms_p50']} p95={summary['replay_ms_p95']}")
+    print(f"Delta medio ms:            {summary['delta_ms_mean']} ({summary['latency_compared']} consultas comparables)")
+
+    changed = sorted(results, key=lambda r: min(r["kb1_overlap"], r["kb2_overlap"]))[:args.top]
+    if changed:
+        print("\nConsultas con menor solapamiento:")
+        for r in changed:
+            print(f"  KB-1={r['kb1_overlap']:.2f} KB-2={r['kb2_overlap']:.2f}  {r['query'][:80]}")
+    return 0
+
+
+def cli() -> int:
+    parser = argparse.ArgumentParser(description="Replay de trazas de recuperación grabadas")
+    parser.add_argument("traces", help="Fichero JSONL generado con TRACE_RECORD_PATH")
+    parser.add_argument("--backend", choices=["live", "memory"], default="live",
+                        help="live: Qdrant configurado en .env; memory: Qdrant embebido sin servidor")
+    parser.add_argument("--qdrant-path", default=":memory:",
+                        help="Con --backend memory: ':memory:' o directorio de un Qdrant local")
+    parser.add_argument("--seed", help="JSONL de puntos {collection, id, text} a cargar en el backend memory")
+    parser.add_argument("--fake-embeddings", type=int, metavar="DIM",
+                        help="Usar embeddings deterministas falsos de dimensión DIM")
+    parser.add_argument("--with-cache", action="store_true", help="No desactivar la cache de resultados")
+    parser.add_argument("--limit", type=int, default=0, help="Reproducir solo las N primeras trazas")
+    parser.add_argument("--top", type=int, default=10, help="Consultas con menor solapamiento a listar")
+    parser.add_argument("--json", action="store_true", help="Salida JSONL por consulta y resumen final")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    return asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,17 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from memory.postgres_memory import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+@pytest.mark.parametrize("cursor", ["", "no-es-base64!", "MjAyNC0wNS0wMQ", "Zm9vfGJhcg"])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
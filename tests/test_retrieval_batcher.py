@@ -0,0 +1,163 @@
+import asyncio
+
+from tools.qdrant_tools import RetrievalBatcher, RetrievedChunk
+from utils.log import get_trace_id, trace_context
+
+
+class FakeEmbeddings:
+
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+
+def make_tool(name, embeddings, cached=None, fail=False):
+    searches = []
+
+    async def tool(query, **kwargs):
+        raise AssertionError("el batcher no debe llamar a la herramienta directamente")
+
+    async def cache_lookup(query, k, metadata_filter, score_threshold):
+        if cached and query in cached:
+            return ("key", query), cached[query]
+        return None, None
+
+    async def search_by_vectors(requests):
+        searches.append(requests)
+        if fail:
+            raise RuntimeError("qdrant caído")
+        return [
+            [RetrievedChunk(f"{name}:{query}", query, name, vector[0])]
+            for query, vector, _, _, _ in requests
+        ]
+
+    tool.cache_lookup = cache_lookup
+    tool.search_by_vectors = search_by_vectors
+    tool.embeddings = embeddings
+    tool.searches = searches
+    return tool
+
+
+def run(coro):
+    # Un fallo del batcher suele manifestarse como futuros que nunca se resuelven
+    return asyncio.run(asyncio.wait_for(coro, timeout=5))
+
+
+def test_concurrent_calls_share_one_embedding_per_text():
+    embeddings = FakeEmbeddings()
+    tool1 = make_tool("kb1", embeddings)
+    tool2 = make_tool("kb2", embeddings)
+
+    async def scenario():
+        batcher = RetrievalBatcher(window=0.01)
+        batched1, batched2 = batcher.wrap(tool1), batcher.wrap(tool2)
+        results = await asyncio.gather(
+            batched1("tarifas"),
+            batched2("tarifas"),
+            batched1("requisitos"),
+            batched2("tarifas"),
+        )
+        return batcher, results
+
+    batcher, results = run(scenario())
+
+    assert [[chunk.id for chunk in chunks] for chunks in results] == [
+        ["kb1:tarifas"], ["kb2:tarifas"], ["kb1:requisitos"], ["kb2:tarifas"]
+    ]
+    assert embeddings.calls == [["tarifas", "requisitos"]]
+    assert batcher.flushes == 1
+    assert batcher.embedded_texts == 2
+    assert len(tool1.searches) == 1 and len(tool2.searches) == 1
+
+
+def test_cache_hits_skip_embedding_and_are_reported():
+    embeddings = FakeEmbeddings()
+    cached_chunk = RetrievedChunk("kb1:cache", "cacheado", "kb1", 0.9)
+    tool = make_tool("kb1", embeddings, cached={"tarifas": [cached_chunk]})
+
+    async def scenario():
+        batched = RetrievalBatcher(window=0.01).wrap(tool)
+        hits = []
+        results = await asyncio.gather(
+            batched("tarifas", cache_hits=hits),
+            batched("oficinas", cache_hits=hits),
+        )
+        return results, hits
+
+    results, hits = run(scenario())
+
+    assert results[0] == [cached_chunk]
+    assert [chunk.id for chunk in results[1]] == ["kb1:oficinas"]
+    assert sorted(hits) == [False, True]
+    assert embeddings.calls == [["oficinas"]]
+
+
+def test_search_failure_resolves_every_caller():
+    embeddings = FakeEmbeddings()
+    tool = make_tool("kb1", embeddings, fail=True)
+
+    async def scenario():
+        batched = RetrievalBatcher(window=0.01).wrap(tool)
+        return await asyncio.gather(batched("a"), batched("b"), batched("c"))
+
+    assert run(scenario()) == [[], [], []]
+
+
+def test_max_batch_flushes_without_waiting_for_the_window():
+    embeddings = FakeEmbeddings()
+    tool = make_tool("kb1", embeddings)
+
+    async def scenario():
+        # Con una ventana de 60 s solo el límite de tamaño puede vaciar el lote
+        batcher = RetrievalBatcher(window=60, max_batch=3)
+        batched = batcher.wrap(tool)
+        results = await asyncio.gather(*(batched(f"consulta {i}") for i in range(3)))
+        return batcher, results
+
+    batcher, results = run(scenario())
+
+    assert batcher.flushes == 1
+    assert all(len(chunks) == 1 for chunks in results)
+
+
+def test_as_documents_converts_batched_results():
+    embeddings = FakeEmbeddings()
+    tool = make_tool("kb1", embeddings)
+
+    async def scenario():
+        batched = RetrievalBatcher(window=0.01).wrap(tool)
+        return await batched("tarifas", as_documents=True)
+
+    (document,) = run(scenario())
+
+    assert document.page_content == "tarifas"
+    assert document.metadata["_id"] == "kb1:tarifas"
+
+
+def test_flush_runs_under_the_batch_trace_id():
+    embeddings = FakeEmbeddings()
+    tool = make_tool("kb1", embeddings)
+    seen = []
+    search_by_vectors = tool.search_by_vectors
+
+    async def traced_search(requests):
+        seen.append(get_trace_id())
+        return await search_by_vectors(requests)
+
+    tool.search_by_vectors = traced_search
+
+    async def scenario():
+        batched = RetrievalBatcher(window=0.01, trace_id="lote").wrap(tool)
+
+        async def item(index):
+            with trace_context(f"lote-{index}"):
+                return await batched(f"consulta {index}")
+
+        await asyncio.gather(item(0), item(1))
+
+    run(scenario())
+
+    assert seen == ["lote"]
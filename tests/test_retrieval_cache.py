@@ -0,0 +1,41 @@
+import time
+
+from tools.qdrant_tools import RetrievalCache, RetrievedChunk
+
+
+def chunks(*texts):
+    return [RetrievedChunk(i, text, "kb1", 0.5) for i, text in enumerate(texts)]
+
+
+def test_lru_evicts_least_recently_used_within_byte_budget():
+    entry_size = RetrievalCache._estimate_size(chunks("x" * 100))
+    cache = RetrievalCache(max_bytes=entry_size * 2)
+
+    cache.put(("a",), chunks("x" * 100))
+    cache.put(("b",), chunks("y" * 100))
+    assert cache.get(("a",)) is not None
+    cache.put(("c",), chunks("z" * 100))
+
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) is not None
+    assert cache.get(("c",)) is not None
+    assert cache.evictions == 1
+    assert cache.current_bytes <= cache.max_bytes
+
+
+def test_entry_larger_than_budget_is_not_stored():
+    cache = RetrievalCache(max_bytes=10)
+    cache.put(("a",), chunks("x" * 100))
+
+    assert cache.get(("a",)) is None
+    assert cache.current_bytes == 0
+
+
+def test_entries_expire_after_entry_ttl():
+    cache = RetrievalCache(entry_ttl=0.01)
+    cache.put(("a",), chunks("x" * 100))
+    time.sleep(0.02)
+
+    assert cache.get(("a",)) is None
+    assert cache.expirations == 1
+    assert cache.current_bytes == 0
@@ -1,3 +1,19 @@
-from .qdrant_tools import init_qdrant_client, create_retrieval_tool_from_collection
+from .qdrant_tools import (
+    init_qdrant_client,
+    create_retrieval_tool_from_collection,
+    configure_retrieval_cache,
+    get_retrieval_cache_stats,
+    mark_collection_ingested,
+    RetrievalBatcher,
+    RetrievedChunk,
+)
 
-__all__ = ['init_qdrant_client', 'create_retrieval_tool_from_collection']
+__all__ = [
+    'init_qdrant_client',
+    'create_retrieval_tool_from_collection',
+    'configure_retrieval_cache',
+    'get_retrieval_cache_stats',
+    'mark_collection_ingested',
+    'RetrievalBatcher',
+    'RetrievedChunk',
+]
@@ -1,19 +1,207 @@
 import asyncio
-from typing import Any, Dict, List, Optional
+import logging
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-try:
-    from qdrant_client import QdrantClient
-    from langchain_qdrant import QdrantVectorStore
-    from langchain_core.documents import Document
-except Exception:
-    QdrantClient = None
-    QdrantVectorStore = None
-    Document = None
+from utils.log import get_trace_id, trace_context
+
+logger = logging.getLogger(__name__)
+
+
+# Clave del payload con el texto del fragmento; es lo único que se pide a Qdrant
+CONTENT_PAYLOAD_KEY = "text"
+
+
+# qdrant-client se importa al crear el cliente o la herramienta, no al importar
+# el módulo, para no penalizar el arranque.
+def _import_qdrant():
+    try:
+        from qdrant_client import QdrantClient, models
+    except Exception:
+        return None, None
+    return QdrantClient, models
+
+
+# Resultado compacto de recuperación: solo el texto, el id del punto y los
+# scores numéricos. `to_document()` lo convierte a Document de langchain para
+# quien lo necesite.
+class RetrievedChunk:
+
+    __slots__ = ('id', 'text', 'collection', 'vector_score', 'term_score', 'score')
+
+    def __init__(self, id: Any, text: str, collection: str, vector_score: float):
+        self.id = id
+        self.text = text
+        self.collection = collection
+        self.vector_score = vector_score
+        self.term_score = 0.0
+        self.score = 0.0
+
+    @property
+    def page_content(self) -> str:
+        return self.text
+
+    def to_document(self):
+        from langchain_core.documents import Document
+        return Document(
+            page_content=self.text,
+            metadata={
+                '_id': self.id,
+                '_collection_name': self.collection,
+                'score': f"{self.score:.4f}",
+                'vector_score': f"{self.vector_score:.4f}",
+                'term_score': f"{self.term_score:.2f}",
+            }
+        )
+
+    def __repr__(self) -> str:
+        return f"RetrievedChunk(id={self.id!r}, score={self.score:.4f})"
+
+
+# Cache LRU de resultados re-rankeados, acotado por tamaño estimado en bytes.
+# Las claves incluyen la versión de la colección: tras una re-ingesta las
+# entradas viejas dejan de consultarse y el LRU las expulsa. Una re-ingesta que
+# reescribe los mismos IDs no cambia points_count; para ese caso la ingesta
+# debe llamar a mark_collection_ingested(), y como respaldo ninguna entrada se
+# sirve pasados `entry_ttl` segundos.
+class RetrievalCache:
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, version_ttl: float = 30.0, entry_ttl: float = 600.0):
+        self.max_bytes = max_bytes
+        self.version_ttl = version_ttl
+        self.entry_ttl = entry_ttl
+        self._entries: "OrderedDict[Tuple, Tuple[List[Any], int, float]]" = OrderedDict()
+        self._versions: Dict[str, Tuple[Any, float]] = {}
+        self._version_locks: Dict[str, asyncio.Lock] = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    @staticmethod
+    def _estimate_size(chunks: List[Any]) -> int:
+        size = sys.getsizeof(chunks)
+        for chunk in chunks:
+            size += sys.getsizeof(chunk) + sys.getsizeof(chunk.text) + sys.getsizeof(chunk.id)
+            size += 3 * 24  # los tres floats de score
+        return size
+
+    async def collection_version(self, collection_name: str, qdrant_client) -> Any:
+        # Se consulta como mucho una vez cada `version_ttl` segundos por colección
+        cached = self._versions.get(collection_name)
+        now = time.monotonic()
+        if cached and now - cached[1] < self.version_ttl:
+            return cached[0]
+
+        lock = self._version_locks.setdefault(collection_name, asyncio.Lock())
+        async with lock:
+            cached = self._versions.get(collection_name)
+            if cached and time.monotonic() - cached[1] < self.version_ttl:
+                return cached[0]
+
+            loop = asyncio.get_event_loop()
+            info = await loop.run_in_executor(None, lambda: qdrant_client.get_collection(collection_name))
+            # points_count cambia con inserciones/borrados; el marcador de ingesta
+            # (metadata de la colección, si el pipeline de ingesta la escribe)
+            # cubre re-ingestas que mantienen el mismo número de puntos.
+            marker = getattr(getattr(info, 'config', None), 'metadata', None)
+            version = (
+                getattr(info, 'points_count', None),
+                repr(sorted(marker.items())) if isinstance(marker, dict) else None,
+            )
+            if cached and cached[0] != version:
+                self.invalidations += 1
+                logger.info("Colección '%s' cambió: %s -> %s", collection_name, cached[0], version)
+            self._versions[collection_name] = (version, time.monotonic())
+            return version
+
+    def get(self, key: Tuple) -> Optional[List[Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if self.entry_ttl > 0 and time.monotonic() - entry[2] > self.entry_ttl:
+            del self._entries[key]
+            self.current_bytes -= entry[1]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return list(entry[0])
+
+    def put(self, key: Tuple, docs: List[Any]) -> None:
+        size = self._estimate_size(docs)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+        self._entries[key] = (list(docs), size, time.monotonic())
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._versions.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "collection_versions": {name: v for name, (v, _) in self._versions.items()},
+        }
+
+
+_retrieval_cache = RetrievalCache()
+
+
+def configure_retrieval_cache(max_bytes: int, version_ttl: float, entry_ttl: float = 600.0) -> RetrievalCache:
+    global _retrieval_cache
+    _retrieval_cache = RetrievalCache(max_bytes=max_bytes, version_ttl=version_ttl, entry_ttl=entry_ttl)
+    return _retrieval_cache
+
+
+def get_retrieval_cache_stats() -> Dict[str, Any]:
+    return _retrieval_cache.stats()
+
+
+def mark_collection_ingested(qdrant_client, collection_name: str, marker: Optional[str] = None) -> str:
+    # Para el pipeline de ingesta, al terminar de escribir una colección: guarda
+    # un marcador nuevo en la metadata de la colección, que forma parte de la
+    # versión usada en las claves de la cache. Así una re-ingesta que mantiene
+    # los mismos IDs (y el mismo points_count) invalida la cache en todos los
+    # workers en, como mucho, RETRIEVAL_CACHE_VERSION_TTL segundos.
+    marker = marker or f"{time.time():.6f}"
+    qdrant_client.update_collection(collection_name, metadata={"ingested_at": marker})
+    _retrieval_cache._versions.pop(collection_name, None)
+    return marker
 
 
 def init_qdrant_client(url: str, api_key: Optional[str] = None):
+    QdrantClient, _ = _import_qdrant()
     if QdrantClient is None:
-        print("WARNING: qdrant-client o langchain no instalados; las herramientas RAG no estarán disponibles.")
+        logger.warning("qdrant-client o langchain no instalados; las herramientas RAG no estarán disponibles.")
         return None
     kwargs = {}
     if api_key:
@@ -25,89 +213,333 @@ def init_qdrant_client(url: str, api_key: Optional[str] = None):
 def create_retrieval_tool_from_collection(
     collection_name: str, 
     qdrant_client, 
-    embeddings
+    embeddings,
+    vector_name: Optional[str] = None
 ) -> Any:
 
-    if QdrantVectorStore is None or Document is None:
-        async def missing_tool(query: str, metadata_filter: Optional[Dict] = None):
-            return [{"page_content": "Qdrant no disponible: instala qdrant-client/langchain-qdrant"}]
+    _, models = _import_qdrant()
+    if models is None:
+        async def missing_tool(query: str, **kwargs):
+            return [{"page_content": "Qdrant no disponible: instala qdrant-client"}]
 
         return missing_tool
 
+    # Solo el texto del payload y sin vectores: menos bytes por red y menos
+    # deserialización que pedir el payload completo.
+    payload_selector = [CONTENT_PAYLOAD_KEY]
 
-    vectorstore = QdrantVectorStore(
-        client=qdrant_client,
-        collection_name=collection_name,
-        embedding=embeddings,
-        content_payload_key="text", 
-    )
+    def to_chunks(points) -> List[Tuple[RetrievedChunk, float]]:
+        return [
+            (
+                RetrievedChunk(
+                    point.id,
+                    (point.payload or {}).get(CONTENT_PAYLOAD_KEY) or "",
+                    collection_name,
+                    point.score,
+                ),
+                point.score,
+            )
+            for point in points
+        ]
+
+    async def cache_lookup(
+        query: str, 
+        k: int, 
+        metadata_filter: Optional[Dict], 
+        score_threshold: float
+    ) -> Tuple[Optional[Tuple], Optional[List[Any]]]:
+        cache = _retrieval_cache
+        if cache.max_bytes <= 0:
+            return None, None
+        try:
+            version = await cache.collection_version(collection_name, qdrant_client)
+        except Exception as e:
+            logger.warning("No se pudo obtener la versión de '%s': %s: %s", collection_name, type(e).__name__, e)
+            return None, None
+        filter_key = repr(sorted(metadata_filter.items())) if metadata_filter else None
+        cache_key = (
+            collection_name,
+            version,
+            cache.normalize_query(query),
+            k,
+            round(score_threshold, 4),
+            filter_key,
+        )
+        return cache_key, cache.get(cache_key)
 
     async def tool_async(
         query: str, 
         k: int = 18, 
         metadata_filter: Optional[Dict] = None, 
-        score_threshold: float = 0.35
+        score_threshold: float = 0.35,
+        use_cache: bool = True,
+        as_documents: bool = False,
+        cache_hits: Optional[List[bool]] = None
     ) -> List[Any]:
-        
-        try:
-            search_k = k * 4  
-            
-            loop = asyncio.get_event_loop()
-            results = await loop.run_in_executor(
-                None, 
-                lambda: vectorstore.similarity_search_with_score(query, k=search_k)
-            )            
-            query_lower = query.lower()
-            query_terms = set(query_lower.split())
-            
-            scored_docs = []
-            for idx, (doc, vector_score) in enumerate(results):
-                content = getattr(doc, 'page_content', '')
-                
-                if not content or len(content.strip()) < 20:
-                    continue
-                
-                content_lower = content.lower()
-                
-                term_matches = sum(1 for term in query_terms if len(term) > 3 and term in content_lower)
-                term_score = term_matches / max(len(query_terms), 1)
-                
-                has_substantive_text = len([w for w in content_lower.split() if len(w) > 5]) > 10
-                text_quality_bonus = 0.1 if has_substantive_text else 0.0
-                
-                combined_score = (-vector_score if vector_score < 0 else vector_score) + (term_score * 0.3) + text_quality_bonus
+        # cache_hits: si se pasa, se añade True/False según se haya servido
+        # desde la cache (lo usan la grabación de trazas y replay.py)
+        cache_key = None
+        chunks = None
+        if use_cache:
+            cache_key, chunks = await cache_lookup(query, k, metadata_filter, score_threshold)
+        if cache_hits is not None:
+            cache_hits.append(chunks is not None)
+
+        if chunks is None:
+            try:
+                search_k = k * 4  
                 
-                scored_docs.append({
-                    'doc': doc,
-                    'vector_score': vector_score,
-                    'term_score': term_score,
-                    'combined_score': combined_score,
-                    'content': content
-                })
-            
-            scored_docs.sort(key=lambda x: x['combined_score'], reverse=True)
-            
-            filtered_docs = []
-            docs_above_threshold = [item for item in scored_docs if item['combined_score'] >= score_threshold]
-            
-            
-            for idx, item in enumerate(docs_above_threshold[:k]):
-                doc = item['doc']
+                def search():
+                    vector = embeddings.embed_query(query)
+                    return qdrant_client.query_points(
+                        collection_name,
+                        query=vector,
+                        using=vector_name,
+                        limit=search_k,
+                        with_payload=payload_selector,
+                        with_vectors=False,
+                    ).points
+
+                loop = asyncio.get_event_loop()
+                points = await loop.run_in_executor(None, search)
+                chunks = _rerank(query, to_chunks(points), k, score_threshold)
                 
-                if not hasattr(doc, 'metadata'):
-                    doc.metadata = {}
-                doc.metadata['score'] = f"{item['combined_score']:.4f}"
-                doc.metadata['vector_score'] = f"{item['vector_score']:.4f}"
-                doc.metadata['term_score'] = f"{item['term_score']:.2f}"
+                if cache_key is not None:
+                    _retrieval_cache.put(cache_key, chunks)
                 
-                filtered_docs.append(doc)
-            
-            return filtered_docs
-            
-        except Exception as e:
-            print(f"[QDRANT TOOL]  ERROR: {type(e).__name__}: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return []
+            except Exception as e:
+                logger.exception("Error en búsqueda sobre '%s': %s: %s", collection_name, type(e).__name__, e)
+                return []
+
+        if as_documents:
+            return [chunk.to_document() for chunk in chunks]
+        return chunks
+
+    async def search_by_vectors(requests: List[Tuple[str, List[float], int, float, Optional[Tuple]]]) -> List[List[Any]]:
+        # Varias búsquedas con embeddings ya calculados en una sola llamada a
+        # Qdrant (query_batch_points). Cada request: (query, vector, k, threshold, cache_key).
+        batch = [
+            models.QueryRequest(
+                query=vector,
+                using=vector_name,
+                limit=k * 4,
+                with_payload=payload_selector,
+                with_vector=False,
+            )
+            for _, vector, k, _, _ in requests
+        ]
+        loop = asyncio.get_event_loop()
+        responses = await loop.run_in_executor(
+            None,
+            lambda: qdrant_client.query_batch_points(collection_name, requests=batch)
+        )
+
+        outputs = []
+        for (query, _, k, score_threshold, cache_key), response in zip(requests, responses):
+            chunks = _rerank(query, to_chunks(response.points), k, score_threshold)
+            if cache_key is not None:
+                _retrieval_cache.put(cache_key, chunks)
+            outputs.append(chunks)
+        return outputs
+
+    tool_async.cache_lookup = cache_lookup
+    tool_async.search_by_vectors = search_by_vectors
+    tool_async.embeddings = embeddings
 
     return tool_async
+
+
+def _rerank(query: str, results: List[Tuple[RetrievedChunk, float]], k: int, score_threshold: float) -> List[RetrievedChunk]:
+    query_lower = query.lower()
+    query_terms = set(query_lower.split())
+    
+    scored = []
+    for chunk, vector_score in results:
+        content = chunk.text
+        
+        if not content or len(content.strip()) < 20:
+            continue
+        
+        content_lower = content.lower()
+        
+        term_matches = sum(1 for term in query_terms if len(term) > 3 and term in content_lower)
+        term_score = term_matches / max(len(query_terms), 1)
+        
+        has_substantive_text = len([w for w in content_lower.split() if len(w) > 5]) > 10
+        text_quality_bonus = 0.1 if has_substantive_text else 0.0
+        
+        chunk.term_score = term_score
+        chunk.score = (-vector_score if vector_score < 0 else vector_score) + (term_score * 0.3) + text_quality_bonus
+        scored.append(chunk)
+    
+    scored.sort(key=lambda c: c.score, reverse=True)
+    
+    return [chunk for chunk in scored if chunk.score >= score_threshold][:k]
+
+
+def _is_gemini_embeddings(embeddings) -> bool:
+    # Sin importar el SDK de Gemini: si no está cargado, no puede ser una instancia suya
+    module = sys.modules.get("langchain_google_genai")
+    cls = getattr(module, "GoogleGenerativeAIEmbeddings", None) if module else None
+    return cls is not None and isinstance(embeddings, cls)
+
+
+def _embed_queries(embeddings, texts: List[str]) -> List[List[float]]:
+    # Gemini distingue embeddings de consulta y de documento: se pide el tipo
+    # de consulta, igual que embed_query. Otros proveedores (OpenAIEmbeddings)
+    # reenvían kwargs desconocidos a la API, así que no se les pasa task_type.
+    if _is_gemini_embeddings(embeddings):
+        return embeddings.embed_documents(texts, task_type="RETRIEVAL_QUERY")
+    return embeddings.embed_documents(texts)
+
+
+# Agrupa las llamadas a las herramientas de recuperación que llegan dentro de
+# una ventana corta: un solo embed_documents para todas las consultas pendientes
+# y un query_batch_points por colección. Pensado para /chat/batch, donde muchas
+# ejecuciones del agente corren a la vez.
+#
+# El flush corre bajo `trace_id` (el de la petición del lote): si no, heredaría
+# el contexto de la llamada que armó el temporizador y los errores del lote
+# aparecerían con el trace ID de un elemento cualquiera.
+class RetrievalBatcher:
+
+    def __init__(self, window: float = 0.005, max_batch: int = 64, trace_id: Optional[str] = None):
+        self.window = window
+        self.max_batch = max_batch
+        self.trace_id = trace_id
+        self._pending: List[Tuple[Any, Dict[str, Any], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # asyncio solo guarda referencias débiles a las tareas: se retienen aquí
+        # hasta que terminan para que un flush no sea recolectado a medias.
+        self._flush_tasks: Set[asyncio.Task] = set()
+        self.flushes = 0
+        self.embedded_texts = 0
+
+    def wrap(self, tool):
+        if tool is None or not hasattr(tool, 'search_by_vectors'):
+            return tool
+
+        async def batched_tool(
+            query: str, 
+            k: int = 18, 
+            metadata_filter: Optional[Dict] = None, 
+            score_threshold: float = 0.35,
+            use_cache: bool = True,
+            as_documents: bool = False,
+            cache_hits: Optional[List[bool]] = None
+        ) -> List[Any]:
+            future = asyncio.get_running_loop().create_future()
+            self._pending.append((tool, {
+                'query': query,
+                'k': k,
+                'metadata_filter': metadata_filter,
+                'score_threshold': score_threshold,
+                'use_cache': use_cache,
+                'cache_hits': cache_hits,
+                'trace_id': get_trace_id(),
+            }, future))
+            self._schedule()
+            chunks = await future
+            if as_documents:
+                return [chunk.to_document() for chunk in chunks]
+            return chunks
+
+        return batched_tool
+
+    def _schedule(self) -> None:
+        loop = asyncio.get_running_loop()
+        if len(self._pending) >= self.max_batch:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._start_flush)
+
+    def _start_flush(self) -> None:
+        task = asyncio.get_running_loop().create_task(self._flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        self.flushes += 1
+        with trace_context(self.trace_id or get_trace_id()):
+            try:
+                await self._run(pending)
+            except Exception as e:
+                logger.exception(
+                    "Error en lote de recuperación: %s: %s", type(e).__name__, e,
+                    extra={'trace_ids': sorted({params['trace_id'] for _, params, _ in pending})}
+                )
+                for _, _, future in pending:
+                    if not future.done():
+                        future.set_result([])
+
+    async def _run(self, pending: List[Tuple[Any, Dict[str, Any], asyncio.Future]]) -> None:
+        misses = []
+        for tool, params, future in pending:
+            cache_key = None
+            cached_docs = None
+            if params['use_cache']:
+                cache_key, cached_docs = await tool.cache_lookup(
+                    params['query'], params['k'], params['metadata_filter'], params['score_threshold']
+                )
+            if params['cache_hits'] is not None:
+                params['cache_hits'].append(cached_docs is not None)
+            if cached_docs is not None:
+                if not future.done():
+                    future.set_result(cached_docs)
+                continue
+            misses.append((tool, params, cache_key, future))
+        if not misses:
+            return
+
+        # Un embedding por texto distinto, agrupado por objeto de embeddings
+        vectors: Dict[Tuple[int, str], List[float]] = {}
+        by_embeddings: Dict[int, Tuple[Any, List[str]]] = {}
+        for tool, params, _, _ in misses:
+            emb = tool.embeddings
+            _, texts = by_embeddings.setdefault(id(emb), (emb, []))
+            if params['query'] not in texts:
+                texts.append(params['query'])
+        loop = asyncio.get_running_loop()
+        for emb_id, (emb, texts) in by_embeddings.items():
+            embedded = await loop.run_in_executor(None, _embed_queries, emb, texts)
+            self.embedded_texts += len(texts)
+            for text, vector in zip(texts, embedded):
+                vectors[(emb_id, text)] = vector
+
+        by_tool: Dict[int, Tuple[Any, List[Tuple[Any, ...]], List[asyncio.Future], List[str]]] = {}
+        for tool, params, cache_key, future in misses:
+            _, requests, futures, trace_ids = by_tool.setdefault(id(tool), (tool, [], [], []))
+            trace_ids.append(params['trace_id'])
+            requests.append((
+                params['query'],
+                vectors[(id(tool.embeddings), params['query'])],
+                params['k'],
+                params['score_threshold'],
+                cache_key,
+            ))
+            futures.append(future)
+
+        async def search(tool, requests, futures, trace_ids):
+            try:
+                outputs = await tool.search_by_vectors(requests)
+            except Exception as e:
+                logger.exception(
+                    "Error en búsqueda por lotes: %s: %s", type(e).__name__, e,
+                    extra={'trace_ids': sorted(set(trace_ids))}
+                )
+                outputs = [[] for _ in requests]
+            for future, docs in zip(futures, outputs):
+                if not future.done():
+                    future.set_result(docs)
+
+        await asyncio.gather(*(
+            search(tool, requests, futures, trace_ids)
+            for tool, requests, futures, trace_ids in by_tool.values()
+        ))
@@ -1,15 +1,14 @@
 import asyncio
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-try:
-    from langchain_google_genai import ChatGoogleGenerativeAI
-except Exception:
-    ChatGoogleGenerativeAI = None
 
 
 class GeminiClient:
 
     def __init__(self, api_key: str, model: str = "gemini-2.5-flash"):
-        if ChatGoogleGenerativeAI is None:
+        # Import diferido: el SDK de Gemini solo se carga si se usa este cliente
+        try:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+        except Exception:
             raise RuntimeError("Instala langchain-google-genai: pip install langchain-google-genai")
         if not api_key:
             raise RuntimeError("GEMINI_API_KEY no configurada en entorno")
@@ -0,0 +1,195 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import uuid
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+
+# Trace ID de la petición en curso. Al ser un ContextVar se propaga a las
+# tareas de asyncio creadas durante la petición (agente, memoria, herramientas).
+_trace_id: ContextVar[str] = ContextVar("trace_id", default="-")
+
+# Atributos estándar de LogRecord; el resto se considera campo estructurado (extra=)
+_RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "trace_id"}
+
+# Logger compartido para el detalle de recuperación (documentos, scores); tiene
+# nivel propio y se muestrea con LOG_DIAGNOSTICS_SAMPLE_RATE.
+DIAGNOSTICS_LOGGER = "retrieval.diagnostics"
+
+# Umbral de muestreo de diagnóstico sobre 10000 (10000 = todas las peticiones)
+_diagnostics_threshold = 10000
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional["NonBlockingQueueHandler"] = None
+_stream_handler: Optional[logging.Handler] = None
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def get_trace_id() -> str:
+    return _trace_id.get()
+
+
+def set_trace_id(trace_id: Optional[str] = None) -> str:
+    trace_id = trace_id or new_trace_id()
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+@contextmanager
+def trace_context(trace_id: Optional[str] = None) -> Iterator[str]:
+    token = _trace_id.set(trace_id or new_trace_id())
+    try:
+        yield _trace_id.get()
+    finally:
+        _trace_id.reset(token)
+
+
+class TraceIdFilter(logging.Filter):
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Se evalúa en el hilo que emite, antes de encolar
+        record.trace_id = _trace_id.get()
+        return True
+
+
+def _sample_threshold(rate: float) -> int:
+    return int(max(0.0, min(rate, 1.0)) * 10000)
+
+
+def _is_sampled(trace_id: str, threshold: int) -> bool:
+    if threshold >= 10000:
+        return True
+    return zlib.crc32(trace_id.encode("utf-8")) % 10000 < threshold
+
+
+def diagnostics_sampled() -> bool:
+    # Misma decisión que DiagnosticsSampler para la petición en curso. Permite
+    # no construir los registros de diagnóstico de peticiones no muestreadas.
+    return _is_sampled(_trace_id.get(), _diagnostics_threshold)
+
+
+class DiagnosticsSampler(logging.Filter):
+    # La decisión es por trace ID, así que una petición muestreada conserva
+    # todo su detalle de recuperación.
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.threshold = _sample_threshold(rate)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name != DIAGNOSTICS_LOGGER:
+            return True
+        return _is_sampled(getattr(record, "trace_id", "-"), self.threshold)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # Nunca bloquea al que emite: si la cola está llena el registro se descarta
+    # y se contabiliza. El formateo se hace en el hilo del listener.
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] [%(trace_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extras = {k: v for k, v in vars(record).items() if k not in _RESERVED_ATTRS and not k.startswith("_")}
+        if extras:
+            line += " " + " ".join(f"{k}={v}" for k, v in extras.items())
+        return line
+
+
+def setup_logging(
+    level: str = "INFO",
+    fmt: str = "json",
+    diagnostics_level: str = "WARNING",
+    diagnostics_sample_rate: float = 1.0,
+    queue_size: int = 10000,
+) -> None:
+    global _listener, _queue_handler, _stream_handler, _diagnostics_threshold
+    if _listener is not None:
+        return
+    _diagnostics_threshold = _sample_threshold(diagnostics_sample_rate)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    _stream_handler = stream_handler
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    _queue_handler.addFilter(TraceIdFilter())
+    _queue_handler.addFilter(DiagnosticsSampler(diagnostics_sample_rate))
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(level.upper())
+    logging.getLogger(DIAGNOSTICS_LOGGER).setLevel(diagnostics_level.upper())
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    # Vacía la cola pendiente y deja el StreamHandler directamente en el root,
+    # para que los registros posteriores (p. ej. el cierre de uvicorn) se
+    # sigan escribiendo aunque ya no haya listener.
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+
+    root = logging.getLogger()
+    if _queue_handler is not None:
+        root.removeHandler(_queue_handler)
+    if _stream_handler is not None:
+        # Mismos filtros (trace ID, muestreo) que tenía el handler de la cola
+        for log_filter in (_queue_handler.filters if _queue_handler else []):
+            _stream_handler.addFilter(log_filter)
+        root.addHandler(_stream_handler)
+
+
+def get_logging_stats() -> dict:
+    if _queue_handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
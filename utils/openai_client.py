@@ -1,15 +1,13 @@
 import asyncio
 from tenacity import retry, stop_after_attempt, wait_exponential
 from typing import List
-try:
-    from openai import OpenAI
-except Exception:
-        print("Instala openai: pip install openai")
-        OpenAI = None
 
 class OpenAIClient:
     def __init__(self, api_key: str, base_url: str, embedding_model: str = "text-embedding-multilingual-e5-large-instruct"):
-        if OpenAI is None:
+        # Import diferido: el SDK de OpenAI solo se carga si se usa este cliente
+        try:
+            from openai import OpenAI
+        except Exception:
             raise RuntimeError("Instala openai: pip install openai")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY no configurada en entorno")
@@ -0,0 +1,84 @@
+import importlib
+import logging
+import time
+from typing import Dict, List
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _uses_gemini() -> bool:
+    return settings.STATUS == "production" and bool(settings.GEMINI_API_KEY)
+
+
+def provider_modules() -> List[str]:
+    # SDKs que build_llm/build_embeddings y el cliente de Qdrant van a necesitar
+    if _uses_gemini():
+        return ["langchain_google_genai", "qdrant_client"]
+    return ["openai", "langchain_openai", "qdrant_client"]
+
+
+def import_provider_modules() -> Dict[str, float]:
+    # Importa los SDKs uno tras otro en un único hilo. Comparten gran parte del
+    # grafo de imports (httpx, pydantic, langchain_core): importarlos a la vez
+    # desde varios hilos no ahorra tiempo por el GIL y puede acabar en un
+    # _DeadlockError de importlib o en un módulo a medio cargar. Después los
+    # constructores ya solo hacen trabajo de E/S y pueden ir en paralelo.
+    seconds: Dict[str, float] = {}
+    for name in provider_modules():
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logger.warning("No se pudo importar %s: %s: %s", name, type(e).__name__, e)
+        seconds[name] = round(time.perf_counter() - started, 4)
+    return seconds
+
+
+# Constructores del LLM y de los embeddings según STATUS. Viven fuera de main.py
+# para que herramientas offline (replay.py) los usen sin arrancar el servidor.
+def build_llm():
+    # Solo se importa el SDK del proveedor que corresponde a STATUS
+    if _uses_gemini():
+        try:
+            from utils.gemini_client import GeminiClient
+            llm = GeminiClient(settings.GEMINI_API_KEY)
+            logger.info("Cliente Gemini inicializado correctamente")
+            return llm
+        except Exception as e:
+            logger.error("No se pudo inicializar Gemini client: %s", e)
+            return None
+
+    try:
+        from utils.openai_client import OpenAIClient
+        llm = OpenAIClient(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_URL)
+        logger.info("Cliente OpenAI inicializado correctamente")
+        return llm
+    except Exception as e:
+        logger.error("No se pudo inicializar OpenAI client: %s", e)
+        return None
+
+
+def build_embeddings():
+    try:
+        if _uses_gemini():
+            from langchain_google_genai import GoogleGenerativeAIEmbeddings
+            embeddings = GoogleGenerativeAIEmbeddings(
+                model="models/text-embedding-004",
+                google_api_key=settings.GEMINI_API_KEY
+            )
+            logger.info("Embeddings de Gemini inicializados correctamente")
+            return embeddings
+
+        logger.info("Usando embeddings de OpenAI local para entorno de desarrollo")
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(
+            model="text-embedding-multilingual-e5-large-instruct",
+            openai_api_key=settings.OPENAI_API_KEY,
+            openai_api_base=settings.OPENAI_URL,
+            check_embedding_ctx_length=False  # Desactiva validación de longitud
+        )
+    except Exception as e:
+        logger.exception("Error inicializando embeddings: %s", e)
+        return None
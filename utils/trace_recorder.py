@@ -0,0 +1,153 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from utils.log import get_trace_id
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def summarize_docs(docs: List[Any]) -> List[List[Any]]:
+    # [[point_id, score], ...] con el score combinado del re-ranking
+    hits = []
+    for doc in docs:
+        score = getattr(doc, 'score', None)
+        hits.append([getattr(doc, 'id', None), round(score, 4) if score is not None else None])
+    return hits
+
+
+def build_record(
+    query: str,
+    classification: Dict[str, Any],
+    docs1: List[Any],
+    docs2: List[Any],
+    prompt_chars: int,
+    timings: Dict[str, float],
+    cache: Optional[Dict[str, Optional[str]]] = None,
+) -> Dict[str, Any]:
+    return {
+        "ts": round(time.time(), 3),
+        "trace_id": get_trace_id(),
+        "query": query,
+        "cls": {
+            "prioritize": classification.get('prioritize'),
+            "t1": classification.get('threshold_kb1'),
+            "t2": classification.get('threshold_kb2'),
+        },
+        "kb1": summarize_docs(docs1),
+        "kb2": summarize_docs(docs2),
+        "prompt_chars": prompt_chars,
+        "ms": timings,
+        # Por KB: "hit", "miss" o "mixed" según la cache de resultados
+        "cache": cache or {},
+    }
+
+
+def read_records(path: str, stats: Optional[Dict[str, int]] = None) -> Iterator[Dict[str, Any]]:
+    # Las líneas ilegibles (última línea truncada por un worker que murió,
+    # escrituras intercaladas de varios procesos) se omiten y se cuentan en
+    # stats["malformed"] en lugar de abortar la lectura.
+    stats = stats if stats is not None else {}
+    stats.setdefault("malformed", 0)
+    with open(path, "r", encoding="utf-8") as fh:
+        for line_number, line in enumerate(fh, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                stats["malformed"] += 1
+                logger.warning("Línea %d de %s malformada, se omite", line_number, path)
+                continue
+            if not isinstance(record, dict):
+                stats["malformed"] += 1
+                logger.warning("Línea %d de %s no es un objeto JSON, se omite", line_number, path)
+                continue
+            yield record
+
+
+# Grabador opcional de trazas por petición (consulta, clasificación, IDs y
+# scores recuperados, tamaño del prompt y tiempos por etapa) en un fichero
+# JSONL de solo-append. La escritura ocurre en un hilo aparte; si la cola se
+# llena el registro se descarta, nunca se bloquea la petición.
+class TraceRecorder:
+
+    def __init__(self, path: str, sample_rate: float = 1.0, queue_size: int = 1000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.recorded = 0
+        self.dropped = 0
+        # Se abre aquí y no en el hilo escritor: una ruta inválida falla en el
+        # bootstrap en lugar de matar el hilo en silencio.
+        self._file = open(path, "a", encoding="utf-8")
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._writer, name="trace-recorder", daemon=True)
+        self._thread.start()
+        logger.info("Grabación de trazas activa en %s (muestreo=%.2f)", path, sample_rate)
+
+    def record_request(
+        self,
+        query: str,
+        classification: Dict[str, Any],
+        docs1: List[Any],
+        docs2: List[Any],
+        prompt_chars: int,
+        timings: Dict[str, float],
+        cache: Optional[Dict[str, Optional[str]]] = None,
+    ) -> None:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        record = build_record(query, classification, docs1, docs2, prompt_chars, timings, cache)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer(self) -> None:
+        fh = self._file
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=0.5)
+                except queue.Empty:
+                    if self._stopping.is_set():
+                        return
+                    continue
+                if item is _STOP:
+                    return
+                try:
+                    fh.write(json.dumps(item, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+                    self.recorded += 1
+                    if self._queue.empty():
+                        fh.flush()
+                except Exception as e:
+                    self.dropped += 1
+                    logger.error("Error escribiendo traza en %s: %s: %s", self.path, type(e).__name__, e)
+        finally:
+            fh.close()
+
+    def close(self, timeout: float = 5.0) -> None:
+        # Bloqueante (join): desde código async llamarlo vía run_in_executor
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(_STOP)
+        except queue.Full:
+            # Con la cola llena el escritor termina al vaciarla (ve _stopping)
+            pass
+        self._thread.join(timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize(),
+        }